@@ -1,8 +1,18 @@
+import hashlib
+from pathlib import Path
+
 import streamlit as st
 import pandas as pd
-import openpyxl
-import io
-import base64
+
+from excel_io import (
+    load_excel_file,
+    _arrow_table,
+    _build_xlsx_bytes,
+    _has_macros,
+    _scan_sheet,
+    _read_sheet,
+    _sheet_stats,
+)
 
 # Page configuration
 st.set_page_config(
@@ -12,90 +22,54 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-def clean_dataframe(df):
-    """Clean dataframe to handle mixed data types and display issues"""
+def display_formulas_info(file_hash, file_bytes, sheet_name, auto_analyze=False):
+    """Display formula information for a sheet"""
     try:
-        # Make a copy to avoid modifying original
-        df_clean = df.copy()
-        
-        # Handle mixed data types in columns
-        for col in df_clean.columns:
-            # Convert problematic columns to string to avoid Arrow errors
-            if df_clean[col].dtype == 'object':
-                # Check for mixed types that cause Arrow issues
-                sample_values = df_clean[col].dropna().head(10)
-                if len(sample_values) > 0:
-                    types = sample_values.apply(type).unique()
-                    if len(types) > 1:
-                        # Mixed types - convert to string
-                        df_clean[col] = df_clean[col].astype(str)
-        
-        # Replace NaN values with empty strings
-        df_clean = df_clean.fillna('')
-        
-        # Clean column names
-        df_clean.columns = [f'Column_{i}' if str(col).startswith('Unnamed:') else str(col) 
-                           for i, col in enumerate(df_clean.columns)]
-        
-        return df_clean
-        
-    except Exception as e:
-        st.warning(f"Error cleaning dataframe: {str(e)}")
-        return df
+        # No cheap pre-check here: Excel writes xl/calcChain.xml for
+        # workbooks with formulas, but openpyxl and other writers do
+        # not, so its absence proves nothing. The scan itself is the
+        # authority - it is cached, parallel, and renders nothing when
+        # a sheet has no formulas.
 
-def load_excel_file(uploaded_file):
-    """Load Excel file and return workbook and sheet names"""
-    try:
-        # Load workbook with openpyxl to preserve formulas and macros
-        workbook = openpyxl.load_workbook(uploaded_file, data_only=False, keep_vba=True)
-        sheet_names = workbook.sheetnames
-        
-        # Load with pandas and clean data types
-        excel_data = {}
-        for sheet_name in sheet_names:
-            try:
-                # Read the sheet
-                df = pd.read_excel(uploaded_file, sheet_name=sheet_name, engine='openpyxl')
-                
-                # Clean the dataframe for better display
-                df = clean_dataframe(df)
-                excel_data[sheet_name] = df
-                
-            except Exception as e:
-                st.warning(f"Could not read sheet '{sheet_name}': {str(e)}")
-                excel_data[sheet_name] = pd.DataFrame()
-        
-        return workbook, sheet_names, excel_data
-    except Exception as e:
-        st.error(f"Error loading Excel file: {str(e)}")
-        return None, None, None
+        # st.tabs runs every tab body per rerun, so an unconditional call
+        # here would scan all N sheets up front. The checkbox defers the
+        # scan until a sheet is actually inspected (the first tab opts in
+        # by default); cached results keep later reruns free.
+        if not st.checkbox(
+            "🔎 Analyze formulas", value=auto_analyze, key=f"analyze_{sheet_name}"
+        ):
+            return
 
-def display_formulas_info(workbook, sheet_name):
-    """Display formula information for a sheet"""
-    try:
-        worksheet = workbook[sheet_name]
-        formulas = []
-        
-        for row in worksheet.iter_rows():
-            for cell in row:
-                if cell.data_type == 'f':  # Formula cell
-                    formulas.append({
-                        'Cell': cell.coordinate,
-                        'Formula': str(cell.value),
-                        'Value': str(cell.displayed_value) if cell.displayed_value else ''
-                    })
-        
-        if formulas:
-            with st.expander(f"🔢 Formulas in {sheet_name} ({len(formulas)} found)", expanded=False):
-                formula_df = pd.DataFrame(formulas)
+        # One fused scan provides the formula columns and the cell
+        # tallies; this function just renders what the cache returns.
+        coords, texts, values, value_count, empty_count, unique_count, complex_count = (
+            _scan_sheet(file_hash, file_bytes, sheet_name)
+        )
+
+        if coords:
+            with st.expander(f"🔢 Formulas in {sheet_name} ({len(coords)} found)", expanded=False):
+                st.caption(
+                    f"{len(coords)} formula cells ({unique_count} unique, "
+                    f"{complex_count} complex) · {value_count} value cells · "
+                    f"{empty_count} empty cells in the used range"
+                )
+                # Dict-of-lists is the fast, inference-free DataFrame
+                # construction path.
+                formula_df = pd.DataFrame({'Cell': coords, 'Formula': texts, 'Value': values})
                 st.dataframe(formula_df, use_container_width=True)
     except Exception as e:
         st.warning(f"Could not analyze formulas: {str(e)}")
 
-def display_macro_info(workbook):
+def display_macro_info(file_hash, file_bytes, file_ext):
     """Display macro/VBA information if present"""
     try:
-        if hasattr(workbook, 'vba_archive') and workbook.vba_archive:
+        # Only .xlsm can carry macros; for anything else skip even the
+        # ZIP peek.
+        if file_ext != '.xlsm':
+            st.info("📄 Standard Excel file (no macros detected)")
+            return
+
+        if _has_macros(file_hash, file_bytes):
             st.success("🔧 **Macro-enabled Excel file detected!**")
             with st.expander("ℹ️ Macro Information", expanded=False):
                 st.info("⚠️ Macros are preserved but won't execute in the browser for security reasons.")
@@ -104,26 +78,11 @@ def display_macro_info(workbook):
     except Exception as e:
         st.info("ℹ️ Could not detect macro information")
 
-def create_download_link(df, filename):
-    """Create a download link for the DataFrame"""
-    try:
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Sheet1')
-        
-        output.seek(0)
-        b64 = base64.b64encode(output.read()).decode()
-        href = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" download="{filename}">📥 Download {filename}</a>'
-        return href
-    except Exception as e:
-        st.error(f"Error creating download link: {str(e)}")
-        return None
-
 def main():
     # Header
     st.title("📊 Interactive Excel Dashboard")
     st.markdown("Upload your Excel file to view and interact with all sheets")
-    
+
     # Sidebar for file upload
     with st.sidebar:
         st.header("📁 File Upload")
@@ -132,29 +91,56 @@ def main():
             type=['xlsx', 'xls', 'xlsm'],
             help="Upload an Excel file with multiple sheets (supports macro-enabled files)"
         )
-        
+
         if uploaded_file:
             st.success(f"✅ File: {uploaded_file.name}")
             st.info(f"📏 Size: {uploaded_file.size / 1024:.1f} KB")
-    
+
     if uploaded_file is not None:
+        # Read the bytes once and hash them once; the hash is the cache
+        # key for every helper, so reruns (tab switches, button clicks)
+        # hash a 32-char string instead of re-hashing megabytes of file.
+        # The extension is likewise parsed once and threaded through.
+        file_bytes = uploaded_file.getvalue()
+        file_hash = hashlib.md5(file_bytes).hexdigest()
+        file_ext = Path(uploaded_file.name).suffix.lower()
+
         # Load the Excel file
         with st.spinner("🔄 Loading Excel file..."):
-            workbook, sheet_names, excel_data = load_excel_file(uploaded_file)
-        
-        if workbook and sheet_names and excel_data:
+            sheet_names = load_excel_file(file_hash, file_bytes)
+
+        if sheet_names:
             st.success(f"✅ Successfully loaded {len(sheet_names)} sheets")
-            
+
             # Display macro information
-            display_macro_info(workbook)
-            
+            display_macro_info(file_hash, file_bytes, file_ext)
+
+            # Whole-file download streams the original upload bytes
+            # back as-is - no re-serialization, no base64 copy.
+            mime_type = (
+                "application/vnd.ms-excel.sheet.macroEnabled.12"
+                if file_ext == '.xlsm'
+                else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+            st.download_button(
+                label="📥 Download Complete File",
+                data=file_bytes,
+                file_name=uploaded_file.name,
+                mime=mime_type,
+                type="primary"
+            )
+
             # Create tabs for each sheet
             tabs = st.tabs(sheet_names)
-            
+
             for i, (tab, sheet_name) in enumerate(zip(tabs, sheet_names)):
                 with tab:
-                    df = excel_data[sheet_name]
-                    
+                    try:
+                        df = _read_sheet(file_hash, file_bytes, sheet_name)
+                    except Exception as e:
+                        st.warning(f"Could not read sheet '{sheet_name}': {str(e)}")
+                        df = pd.DataFrame()
+
                     if not df.empty:
                         # Display sheet statistics
                         col1, col2, col3, col4 = st.columns(4)
@@ -162,37 +148,66 @@ def main():
                             st.metric("📊 Rows", len(df))
                         with col2:
                             st.metric("📋 Columns", len(df.columns))
+                        nonnull_count, memory_mb = _sheet_stats(file_hash, file_bytes, sheet_name)
                         with col3:
-                            st.metric("✅ Non-null", df.count().sum())
+                            st.metric("✅ Non-null", nonnull_count)
                         with col4:
-                            memory_mb = df.memory_usage(deep=True).sum() / 1024 / 1024
                             st.metric("💾 Memory", f"{memory_mb:.1f} MB")
-                        
+
                         # Display formulas info
-                        display_formulas_info(workbook, sheet_name)
-                        
-                        # Display the data with error handling
+                        display_formulas_info(
+                            file_hash, file_bytes, sheet_name, auto_analyze=(i == 0)
+                        )
+
+                        # Display the data with error handling. Only one
+                        # page of rows goes over the websocket per rerun;
+                        # Table.slice is a zero-copy view of the cached
+                        # Arrow table, so paging costs nothing server-side.
                         st.subheader(f"📋 {sheet_name} Data")
                         try:
-                            st.dataframe(df, use_container_width=True, height=400)
+                            table = _arrow_table(file_hash, file_bytes, sheet_name)
+                            page_size = 1000
+                            num_pages = max(1, -(-table.num_rows // page_size))
+                            page = 1
+                            if num_pages > 1:
+                                page = st.number_input(
+                                    f"Page (of {num_pages})", 1, num_pages, 1,
+                                    key=f"page_{i}"
+                                )
+                            st.dataframe(
+                                table.slice((page - 1) * page_size, page_size),
+                                use_container_width=True,
+                                height=400
+                            )
                         except Exception as e:
                             st.error(f"Error displaying data: {str(e)}")
                             st.markdown("**Raw data preview:**")
                             st.text(str(df.head()))
-                        
-                        # Download section
+
+                        # Download section. st.download_button streams the
+                        # bytes directly instead of embedding a base64 data
+                        # URI in the page DOM; the cached builder makes
+                        # repeat renders and clicks free. The builder runs
+                        # during tab render, so a serialization failure
+                        # must not take down the rest of the page.
                         st.markdown("---")
-                        if st.button(f"📥 Download {sheet_name}", key=f"download_{i}"):
-                            download_link = create_download_link(df, f"{sheet_name}.xlsx")
-                            if download_link:
-                                st.markdown(download_link, unsafe_allow_html=True)
+                        try:
+                            st.download_button(
+                                label=f"📥 Download {sheet_name}",
+                                data=_build_xlsx_bytes(file_hash, file_bytes, sheet_name),
+                                file_name=f"{sheet_name}.xlsx",
+                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                key=f"download_{i}"
+                            )
+                        except Exception as e:
+                            st.error(f"Error preparing download: {str(e)}")
                     else:
                         st.warning("⚠️ This sheet is empty or could not be read")
-    
+
     else:
         # Welcome message
         st.info("👆 Please upload an Excel file using the sidebar to get started")
-        
+
         # Feature showcase
         st.markdown("""
         ### 🚀 Features:
@@ -201,7 +216,7 @@ def main():
         - **🔧 Macro support**: Handle .xlsm files with VBA macros
         - **📥 Download capability**: Export individual sheets
         - **🔒 Data cleaning**: Automatic handling of mixed data types
-        
+
         ### 📁 Supported formats:
         - **`.xlsm`** - Excel with macros
         - **`.xlsx`** - Standard Excel 2007+
@@ -0,0 +1,346 @@
+"""Shared Excel loading, cleaning and serialization helpers.
+
+Everything here is UI-free apart from Streamlit cache decorators and
+warning/error toasts, so any entrypoint importing these helpers shares
+one set of cached parses per uploaded file.
+
+Cached helpers take (file_hash, _file_bytes, ...): the md5 hash is
+computed once per rerun in main() and acts as the cache key, while the
+underscore prefix tells Streamlit not to re-hash the raw bytes on every
+call.
+"""
+
+import io
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+import streamlit as st
+import pandas as pd
+import pyarrow as pa
+import openpyxl
+from openpyxl.utils.cell import range_boundaries
+
+def clean_dataframe(df):
+    """Clean dataframe to handle mixed data types and display issues"""
+    try:
+        # Shallow copy only: column blocks are shared until written, so
+        # the caller's frame stays untouched without duplicating the
+        # whole DataFrame up front. The mutations below (astype, fillna,
+        # column rename) all allocate new blocks for just the columns
+        # they change.
+        df_clean = df.copy(deep=False)
+
+        # Handle mixed data types in columns. Arrow-backed columns are
+        # homogeneous by construction, so this only triggers for object
+        # columns (e.g. when a read falls back to the numpy backend).
+        for col in df_clean.select_dtypes(include='object').columns:
+            # Convert problematic columns to string to avoid Arrow errors.
+            # pandas' own C-level inference on a small sample replaces the
+            # old per-cell type() calls; a 100-row sample is enough to
+            # catch mixed columns without scanning millions of values.
+            inferred = pd.api.types.infer_dtype(df_clean[col].head(100), skipna=True)
+            if inferred.startswith('mixed'):
+                # Mixed types - convert to string
+                df_clean[col] = df_clean[col].astype(str)
+
+        # Replace missing values with empty strings, but only in text
+        # columns - object or Arrow-backed string (is_string_dtype
+        # covers both): filling '' into numeric/datetime columns would
+        # force them to object dtype (~5-10x the memory) and break the
+        # zero-copy Arrow conversion. st.dataframe renders NaN/NaT as
+        # empty cells natively.
+        text_cols = [
+            col for col in df_clean.columns
+            if pd.api.types.is_string_dtype(df_clean[col].dtype)
+        ]
+        df_clean[text_cols] = df_clean[text_cols].fillna('')
+
+        # Clean column names: vectorized str cast, then one rename over
+        # just the pandas-generated 'Unnamed: N' placeholders instead of
+        # rewriting the whole axis element by element.
+        df_clean.columns = df_clean.columns.astype(str)
+        renames = {col: f'Column_{i}' for i, col in enumerate(df_clean.columns)
+                   if col.startswith('Unnamed:')}
+        if renames:
+            df_clean.rename(columns=renames, inplace=True)
+
+        return df_clean
+
+    except Exception as e:
+        st.warning(f"Error cleaning dataframe: {str(e)}")
+        return df
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _has_macros(file_hash, _file_bytes):
+    """Check for VBA macros by peeking at the ZIP directory.
+
+    A macro-enabled workbook always carries xl/vbaProject.bin, so a
+    central-directory scan answers in microseconds what a full
+    load_workbook(keep_vba=True) pass answered in seconds.
+    """
+    try:
+        return 'xl/vbaProject.bin' in zipfile.ZipFile(io.BytesIO(_file_bytes)).namelist()
+    except Exception:
+        # Not a readable ZIP (e.g. legacy .xls) - no OOXML macro part
+        return False
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _sheet_names(file_hash, _file_bytes):
+    """List the sheet names without reading any cell data"""
+    # The Rust-based calamine engine parses the workbook metadata
+    # natively and is several times faster than openpyxl; openpyxl is
+    # kept only for the formula/VBA inspection path.
+    return pd.ExcelFile(io.BytesIO(_file_bytes), engine='calamine').sheet_names
+
+# persist="disk" survives app restarts and cache evictions: re-uploading
+# the same file (same md5 key) skips parsing entirely on later runs.
+@st.cache_data(show_spinner=False, max_entries=32, persist="disk")
+def _read_all_sheets(file_hash, _file_bytes):
+    """Read every sheet concurrently into cleaned DataFrames.
+
+    st.tabs renders all tab bodies on the first run, so every sheet is
+    needed up front anyway. The per-sheet parses are independent and the
+    GIL is released inside calamine, so a thread pool cuts first-paint
+    latency to roughly the largest sheet's parse time. Each worker gets
+    its own BytesIO for file-position isolation.
+    """
+    sheet_names = _sheet_names(file_hash, _file_bytes)
+    with ThreadPoolExecutor(max_workers=min(8, max(1, len(sheet_names)))) as executor:
+        futures = {
+            # dtype_backend='pyarrow' skips the numpy coercion pass and
+            # keeps strings in Arrow buffers - roughly half the memory
+            # of object dtype and a free st.dataframe conversion. The
+            # frames are display-only, so nothing downstream needs numpy
+            # semantics.
+            name: executor.submit(
+                pd.read_excel, io.BytesIO(_file_bytes), sheet_name=name,
+                engine='calamine', dtype_backend='pyarrow'
+            )
+            for name in sheet_names
+        }
+
+        excel_data = {}
+        for name, future in futures.items():
+            try:
+                excel_data[name] = clean_dataframe(future.result())
+            except Exception as e:
+                st.warning(f"Could not read sheet '{name}': {str(e)}")
+                excel_data[name] = pd.DataFrame()
+
+    return excel_data
+
+def _read_sheet(file_hash, file_bytes, sheet_name):
+    """Return one sheet's cleaned DataFrame from the cached batch read"""
+    return _read_all_sheets(file_hash, file_bytes)[sheet_name]
+
+def load_excel_file(file_hash, file_bytes):
+    """Load Excel file and return its sheet names.
+
+    Sheet data is deliberately not read here: each tab reads its own
+    sheet via the cached _read_sheet, so a sheet is parsed at most once
+    per session and only if its tab is rendered. Formula and macro
+    inspection likewise run lazily off the raw bytes.
+    """
+    try:
+        return _sheet_names(file_hash, file_bytes)
+    except Exception as e:
+        st.error(f"Error loading Excel file: {str(e)}")
+        return None
+
+# OOXML namespaces used by the raw-XML formula scan
+_SSML = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_RELS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _sheet_xml_paths(file_hash, _file_bytes):
+    """Map each sheet name to its worksheet XML part inside the XLSX ZIP"""
+    archive = zipfile.ZipFile(io.BytesIO(_file_bytes))
+    rels = {
+        rel.get('Id'): rel.get('Target')
+        for rel in ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    }
+
+    paths = {}
+    workbook_xml = ET.fromstring(archive.read('xl/workbook.xml'))
+    for sheet in workbook_xml.iter(f'{_SSML}sheet'):
+        target = rels[sheet.get(f'{_RELS}id')]
+        paths[sheet.get('name')] = target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+    return paths
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _shared_strings(file_hash, _file_bytes):
+    """Load the SharedStrings table, used to resolve cached string values"""
+    archive = zipfile.ZipFile(io.BytesIO(_file_bytes))
+    try:
+        root = ET.fromstring(archive.read('xl/sharedStrings.xml'))
+    except KeyError:
+        return []
+    return [
+        ''.join(t.text or '' for t in si.iter(f'{_SSML}t'))
+        for si in root.iter(f'{_SSML}si')
+    ]
+
+def _scan_sheet_xml(file_bytes, sheet_path, shared_strings):
+    """Scan one sheet's XML, returning formulas and cell counts.
+
+    Reads the worksheet XML straight from the ZIP with iterparse instead
+    of going through openpyxl: only <c> elements carrying an <f> child
+    are inspected in depth, the cached <v> value comes along in the same
+    pass (Excel stores the last computed result in the file), and
+    clearing each row keeps memory constant regardless of sheet size.
+    The cost of a scan is the XML bytes read, so the cell tallies, the
+    distinct-formula count and the complex-formula count (text longer
+    than 50 chars) all ride along in the same walk rather than paying
+    for separate traversals. Counts are derived, not inspected: the
+    value count is occupied cells minus formula cells, and the empty
+    count falls out of the sheet's <dimension> extent, so non-formula
+    cells cost a single tag check each. Formulas
+    come back as parallel (coords, texts, values) lists - the columnar
+    shape pd.DataFrame ingests directly, with no per-row dict or tuple
+    allocations. Returns (coords, texts, values, value_count,
+    empty_count, unique_count, complex_count); the formula count is
+    len(coords).
+
+    Pure function of its arguments (no Streamlit cache access), so
+    _scan_sheets can safely run it from worker threads; each call opens
+    its own ZipFile over the shared immutable bytes.
+    """
+    archive = zipfile.ZipFile(io.BytesIO(file_bytes))
+
+    coords = []
+    texts = []
+    values = []
+    shared_formulas = {}
+    # Uniqueness is tracked by 64-bit fingerprints rather than the
+    # formula strings themselves: ~8 bytes per entry instead of the
+    # full text, with a vanishing collision rate at workbook scale.
+    fingerprints = set()
+    total_cells = 0
+    occupied_count = 0
+    complex_count = 0
+    with archive.open(sheet_path) as source:
+        for _, elem in ET.iterparse(source):
+            if elem.tag == f'{_SSML}dimension':
+                # The used-range extent is declared up front; its area
+                # gives the empty-cell count for free once we know how
+                # many cells actually appear in the XML.
+                ref = elem.get('ref')
+                if ref:
+                    min_col, min_row, max_col, max_row = range_boundaries(ref)
+                    total_cells = (max_col - min_col + 1) * (max_row - min_row + 1)
+                continue
+            if elem.tag != f'{_SSML}row':
+                continue
+            for cell in elem.iter(f'{_SSML}c'):
+                occupied_count += 1
+                f_elem = cell.find(f'{_SSML}f')
+                if f_elem is None:
+                    continue
+
+                # Shared formulas store the text only on the master cell;
+                # follower cells reference it by the si index.
+                text = f_elem.text
+                if f_elem.get('t') == 'shared':
+                    si = f_elem.get('si')
+                    if text:
+                        shared_formulas[si] = text
+                    else:
+                        text = shared_formulas.get(si, '')
+
+                v_elem = cell.find(f'{_SSML}v')
+                value = v_elem.text if v_elem is not None and v_elem.text else ''
+                if cell.get('t') == 's' and value:
+                    value = shared_strings[int(value)]
+
+                formula_text = f'={text or ""}'
+                fingerprints.add(hash(formula_text) & 0xFFFFFFFFFFFFFFFF)
+                if len(formula_text) > 50:
+                    complex_count += 1
+                coords.append(cell.get('r'))
+                texts.append(formula_text)
+                values.append(value)
+            elem.clear()
+
+    value_count = occupied_count - len(coords)
+    empty_count = max(0, total_cells - occupied_count)
+    return coords, texts, values, value_count, empty_count, len(fingerprints), complex_count
+
+@st.cache_data(show_spinner=False, max_entries=32, persist="disk")
+def _scan_sheets(file_hash, _file_bytes):
+    """Scan every sheet's XML concurrently, keyed per file.
+
+    The per-sheet scans are independent ZIP reads and the GIL is
+    released during zlib decompression, so a thread pool finishes the
+    whole workbook in roughly the largest sheet's scan time. The
+    cached lookups (part paths, shared strings) are resolved once here
+    and passed into the pure per-sheet worker.
+    """
+    sheet_paths = _sheet_xml_paths(file_hash, _file_bytes)
+    shared_strings = _shared_strings(file_hash, _file_bytes)
+    with ThreadPoolExecutor(max_workers=min(8, max(1, len(sheet_paths)))) as executor:
+        results = executor.map(
+            lambda path: _scan_sheet_xml(_file_bytes, path, shared_strings),
+            sheet_paths.values()
+        )
+    return dict(zip(sheet_paths.keys(), results))
+
+def _scan_sheet(file_hash, file_bytes, sheet_name):
+    """Return one sheet's scan result from the cached batch scan"""
+    return _scan_sheets(file_hash, file_bytes)[sheet_name]
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _arrow_table(file_hash, _file_bytes, sheet_name):
+    """Convert a sheet to a pyarrow Table, cached per file and sheet.
+
+    st.dataframe converts pandas input to Arrow on every rerun; doing
+    the conversion once here and passing the Table directly skips that
+    per-rerun cost, and numeric blocks convert zero-copy now that they
+    keep their native dtypes.
+    """
+    return pa.Table.from_pandas(
+        _read_sheet(file_hash, _file_bytes, sheet_name), preserve_index=False
+    )
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _sheet_stats(file_hash, _file_bytes, sheet_name):
+    """Compute the non-null count and deep memory usage for a sheet.
+
+    Both are O(cells) scans - deep memory_usage even sizes every Python
+    string - so they are cached per (file, sheet) instead of rerunning
+    on every interaction.
+    """
+    df = _read_sheet(file_hash, _file_bytes, sheet_name)
+    nonnull_count = int(df.count().sum())
+    memory_mb = df.memory_usage(deep=True).sum() / 1024 / 1024
+    return nonnull_count, memory_mb
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _build_xlsx_bytes(file_hash, _file_bytes, sheet_name):
+    """Serialize one sheet to xlsx bytes, cached per file and sheet.
+
+    Write-only mode streams rows straight to the ZIP without building a
+    worksheet object graph, so peak memory scales with row width rather
+    than row count, and itertuples iterates the frame at C speed.
+    """
+    df = _read_sheet(file_hash, _file_bytes, sheet_name)
+    # openpyxl cannot serialize NaT, NaN or pd.NA; coerce missing
+    # values to None, which it emits as empty cells. The astype(object)
+    # first is load-bearing: on Arrow-backed frames, where() alone
+    # keeps missing values as pd.NA and ws.append raises on them.
+    df = df.astype(object).where(df.notna(), None)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    ws.append(list(df.columns))
+    for row in df.itertuples(index=False, name=None):
+        ws.append(row)
+
+    # Spool the save through a temp file so exports beyond 16 MB spill
+    # to disk instead of growing an in-memory buffer alongside the
+    # workbook stream. st.download_button needs concrete bytes, so the
+    # final payload is still materialized once (and cached above).
+    with SpooledTemporaryFile(max_size=16 * 1024 * 1024) as output:
+        wb.save(output)
+        output.seek(0)
+        return output.read()